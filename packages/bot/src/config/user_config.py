@@ -80,17 +80,17 @@ class UserConfigManager:
         """Retrieves the entire configuration dictionary for a given user."""
         return self.mongo_store.get_user_config(user_id)
 
-    def get_user_model(self, user_id: int) -> str:
-        """Gets a user's currently selected model."""
-        return self.mongo_store.get_user_model(user_id)
+    def get_user_model(self, user_id: int, config: Optional[Dict[str, Any]] = None) -> str:
+        """Gets a user's currently selected model, from `config` if already fetched."""
+        return self.mongo_store.get_user_model(user_id, config)
 
-    def get_user_system_prompt(self, user_id: int) -> str:
-        """Gets a user's custom system prompt."""
-        return self.mongo_store.get_user_system_prompt(user_id)
+    def get_user_system_prompt(self, user_id: int, config: Optional[Dict[str, Any]] = None) -> str:
+        """Gets a user's custom system prompt, from `config` if already fetched."""
+        return self.mongo_store.get_user_system_prompt(user_id, config)
 
-    def get_user_system_message(self, user_id: int) -> Dict[str, str]:
-        """Constructs the system message dictionary for a user."""
-        return self.mongo_store.get_user_system_message(user_id)
+    def get_user_system_message(self, user_id: int, config: Optional[Dict[str, Any]] = None) -> Dict[str, str]:
+        """Constructs the system message dictionary for a user, from `config` if already fetched."""
+        return self.mongo_store.get_user_system_message(user_id, config)
 
     def get_user_credit(self, user_id: int) -> int:
         """Retrieves a user's current credit balance."""
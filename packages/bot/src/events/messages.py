@@ -117,21 +117,19 @@ def setup_message_events(bot: commands.Bot, dependencies: dict):
     mongodb_store = dependencies['mongodb_store']
     authorized_users = dependencies['authorized_users']
 
-    async def is_authorized_user(user: discord.abc.User) -> bool:
-        if await bot.is_owner(user): return True
-        return getattr(user, "id", 0) in authorized_users
-
     async def process_ai_request(request):
         message = request.message
         user_id = message.author.id
 
         try:
-            user_model = user_config_manager.get_user_model(user_id)
-            user_system_message = user_config_manager.get_user_system_message(user_id)
+            # MongoDB calls are blocking, so run them off the event loop.
+            # The config is fetched once and reused by the getters below
+            user_config = await asyncio.to_thread(user_config_manager.get_user_config, user_id)
+            user_model = user_config_manager.get_user_model(user_id, user_config)
+            user_system_message = user_config_manager.get_user_system_message(user_id, user_config)
 
-            model_info = mongodb_store.get_model_info(user_model)
+            model_info = await asyncio.to_thread(mongodb_store.get_model_info, user_model)
             if model_info:
-                user_config = user_config_manager.get_user_config(user_id)
                 user_level = user_config.get("access_level", 0)
                 required_level = model_info.get("access_level", 0)
                 if user_level < required_level:
@@ -142,8 +140,12 @@ def setup_message_events(bot: commands.Bot, dependencies: dict):
                     await message.channel.send(f"⛔ Không đủ credit. Model này tốn {cost} credit. Số dư của bạn: {user_config.get('credit', 0)}", reference=message)
                     return
 
+            # Load the history (MongoDB read plus any token counting) while attachments download
             attachments = list(message.attachments or [])
-            attachment_data = await _read_attachments_enhanced(attachments)
+            attachment_data, history = await asyncio.gather(
+                _read_attachments_enhanced(attachments),
+                asyncio.to_thread(memory_store.get_user_messages, user_id)
+            )
             combined_text = (attachment_data.get("text_summary", "") + request.final_user_text).strip()
 
             if not combined_text and not attachment_data["has_images"]: return
@@ -152,7 +154,7 @@ def setup_message_events(bot: commands.Bot, dependencies: dict):
             if user_system_message and user_system_message.get('content'):
                 payload_messages.append(user_system_message)
             
-            payload_messages.extend(memory_store.get_user_messages(user_id))
+            payload_messages.extend(history)
 
             user_content: List[Dict[str, Any]] = []
             if combined_text:
@@ -172,11 +174,13 @@ def setup_message_events(bot: commands.Bot, dependencies: dict):
 
             if ok and resp:
                 await send_long_message_with_reference(message.channel, resp, message)
-                memory_store.add_message(user_id, {"role": "user", "content": combined_text})
-                memory_store.add_message(user_id, {"role": "assistant", "content": resp})
+                await asyncio.to_thread(memory_store.add_messages, user_id, [
+                    {"role": "user", "content": combined_text},
+                    {"role": "assistant", "content": resp}
+                ])
 
                 if model_info and model_info.get("credit_cost", 0) > 0:
-                    mongodb_store.deduct_user_credit(user_id, model_info["credit_cost"])
+                    await asyncio.to_thread(mongodb_store.deduct_user_credit, user_id, model_info["credit_cost"])
             elif not ok:
                 await message.channel.send(f"⚠️ Lỗi: {str(resp)[:500]}", reference=message)
 
@@ -194,12 +198,16 @@ def setup_message_events(bot: commands.Bot, dependencies: dict):
         is_mention = bot.user in message.mentions
         if not (is_dm or is_mention): return
 
-        if not await is_authorized_user(message.author):
+        # The owner check doubles as the queue priority, so resolve it only once
+        is_owner = await bot.is_owner(message.author)
+        if not (is_owner or getattr(message.author, "id", 0) in authorized_users):
             await message.channel.send("❌ Bạn không có quyền sử dụng bot này.")
             return
 
         user_text = re.sub(rf"<@!?{bot.user.id}>", "", message.content or "").strip()
-        await request_queue.add_request(message, user_text)
+        queued, reason = await request_queue.add_request(message, user_text, is_owner=is_owner)
+        if not queued:
+            await message.channel.send(reason, reference=message)
 
     request_queue.set_process_callback(process_ai_request)
     logger.info("[OK] Message event listeners have been registered")
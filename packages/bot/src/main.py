@@ -32,6 +32,7 @@ class Bot(commands.Bot):
         @self.event
         async def on_ready():
             logger.info(f"[OK] Bot is ready: {self.user} (id={self.user.id})")
+            get_request_queue().invalidate_owner_ids()
             logger.info(f"Registered prefix commands: {sorted([c.name for c in self.commands])}")
 
         @self.event
@@ -53,6 +54,7 @@ class Bot(commands.Bot):
         memory_store = MemoryStore(mongodb_store)
         user_config_manager = get_user_config_manager()
         request_queue = get_request_queue()
+        request_queue.set_bot(self)
         authorized_users_set = auth_service.load_authorized_users(mongodb_store)
 
         def add_auth_user_wrapper(user_id: int) -> bool:
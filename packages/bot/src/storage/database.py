@@ -3,15 +3,58 @@
 # mongodb_store.py - UPDATED VERSION - Without pmodel support
 
 import logging
-from typing import Dict, List, Optional, Any, Set
-from datetime import datetime
-from pymongo import MongoClient, WriteConcern
-from pymongo.errors import ConnectionFailure, ServerSelectionTimeoutError
+from typing import Dict, List, Optional, Any, Set, Tuple
+from datetime import datetime, timezone
+from pymongo import MongoClient, UpdateOne, WriteConcern
+from pymongo.errors import ConnectionFailure, OperationFailure, ServerSelectionTimeoutError
+from cachetools import TTLCache
 import tiktoken
+import threading
 import time
 
 logger = logging.getLogger("Storage.Database")
 
+# Configuration returned for users without a stored config - hand out copies only
+_DEFAULT_USER_CONFIG: Dict[str, Any] = {
+    "model": "gemini-2.5-flash",
+    "system_prompt": "Tên của bạn là Ryuuko (nữ), nói tiếng việt",
+    "credit": 0,
+    "access_level": 0
+}
+
+# Shared tokenizer - building the encoding is expensive, so it is created once per process
+_TOKENIZER: Optional[tiktoken.Encoding] = None
+_TOK_LOCK = threading.Lock()
+# A failed load (e.g. the encoding download in an offline container) is not retried for a
+# while, so messages are not blocked on the download every time
+_TOKENIZER_RETRY_SECONDS = 300.0
+_tokenizer_failed_at: Optional[float] = None
+# encode_ordinary_batch starts a thread pool per call, which only pays off for larger batches
+_BATCH_TOKENIZE_MIN = 16
+
+
+def _get_tokenizer() -> Optional[tiktoken.Encoding]:
+    """Get the process-wide tokenizer, creating it on first use - None if it cannot be loaded"""
+    global _TOKENIZER, _tokenizer_failed_at
+    if _TOKENIZER is None:
+        with _TOK_LOCK:
+            if _TOKENIZER is None:
+                if _tokenizer_failed_at is not None and time.monotonic() - _tokenizer_failed_at < _TOKENIZER_RETRY_SECONDS:
+                    return None
+                try:
+                    # Use a more reliable tokenizer
+                    try:
+                        _TOKENIZER = tiktoken.encoding_for_model("gpt-4")
+                    except Exception:
+                        _TOKENIZER = tiktoken.get_encoding("cl100k_base")
+                except Exception as e:
+                    if _tokenizer_failed_at is None:
+                        logger.warning(f"Tokenizer unavailable, falling back to estimated token counts: {e}")
+                    _tokenizer_failed_at = time.monotonic()
+                    return None
+                _tokenizer_failed_at = None
+    return _TOKENIZER
+
 
 class MongoDBStore:
     """MongoDB storage manager for Discord OpenAI proxy"""
@@ -22,11 +65,19 @@ class MongoDBStore:
         self.client: Optional[MongoClient] = None
         self.db = None
 
-        # Use a more reliable tokenizer
-        try:
-            self.tokenizer = tiktoken.encoding_for_model("gpt-4")
-        except:
-            self.tokenizer = tiktoken.get_encoding("cl100k_base")
+        # Short-lived cache of user configs - a chat burst reads the same config many times
+        self._config_cache: TTLCache = TTLCache(maxsize=4096, ttl=30)
+        self._config_cache_lock = threading.Lock()
+        # Marker of each in-flight config read; a write drops it so a read that raced with
+        # the write does not cache stale data. Entries live only as long as the read
+        self._config_reads: Dict[int, object] = {}
+
+        # Supported model names rarely change, so keep them in memory for a minute
+        self._models_cache: Optional[Set[str]] = None
+        self._models_cache_ts = 0.0
+        # Bumped on every invalidation so a refresh that raced with it does not cache stale data
+        self._models_cache_generation = 0
+        self._models_cache_lock = threading.Lock()
 
         # Collection names (removedodels)
         self.COLLECTIONS = {
@@ -54,15 +105,18 @@ class MongoDBStore:
                 serverSelectionTimeoutMS=5000,
                 connectTimeoutMS=5000,
                 socketTimeoutMS=5000,
+                # Keep warm connections around for bursty Discord traffic
+                maxPoolSize=50,
+                minPoolSize=5,
+                maxIdleTimeMS=60000,
+                waitQueueTimeoutMS=2000,
                 w=1,  # Change to 1 for standalone
                 journal=True  # Wait for journal acknowledgment
             )
-
-            # Test connection
-            self.client.admin.command('ping')
             self.db = self.client[self.database_name]
 
-            # Create indexes for better performance
+            # Create indexes for better performance - this is also the first round trip,
+            # so an unreachable server surfaces here instead of through a separate ping
             self._create_indexes()
 
             logger.info(f"Successfully connected to MongoDB: {self.database_name}")
@@ -79,10 +133,16 @@ class MongoDBStore:
         try:
             # User config indexes
             self.db[self.COLLECTIONS['user_config']].create_index("user_id", unique=True)
+            # Covers model usage lookups (get_users_using_model, remove_supported_model)
+            self.db[self.COLLECTIONS['user_config']].create_index([("model", 1), ("user_id", 1)])
 
-            # Memory indexes - add compound index for better performance
+            # Memory indexes - every lookup is by user_id, so the unique index is enough
             self.db[self.COLLECTIONS['memory']].create_index("user_id", unique=True)
-            self.db[self.COLLECTIONS['memory']].create_index([("user_id", 1), ("updated_at", -1)])
+            try:
+                # Older deployments also built a (user_id, updated_at) index that only slows writes
+                self.db[self.COLLECTIONS['memory']].drop_index([("user_id", 1), ("updated_at", -1)])
+            except OperationFailure:
+                pass
 
             # Authorized users indexes
             self.db[self.COLLECTIONS['authorized']].create_index("user_id", unique=True)
@@ -91,6 +151,8 @@ class MongoDBStore:
             self.db[self.COLLECTIONS['models']].create_index("model_name", unique=True)
 
             logger.info("MongoDB indexes created successfully")
+        except ConnectionFailure:
+            raise
         except Exception as e:
             logger.exception(f"Error creating indexes: {e}")
 
@@ -99,10 +161,11 @@ class MongoDBStore:
         try:
             count = self.db[self.COLLECTIONS['models']].count_documents({})
             if count == 0:
+                now = datetime.now(timezone.utc)
                 default_models = [
-                    {"model_name": "ryuuko-r1-vnm-mini", "created_at": datetime.utcnow(), "is_default": False,
+                    {"model_name": "ryuuko-r1-vnm-mini", "created_at": now, "is_default": False,
                      "credit_cost": 100, "access_level": 3},
-                    {"model_name": "ryuuko-r1-eng-mini", "created_at": datetime.utcnow(), "is_default": False,
+                    {"model_name": "ryuuko-r1-eng-mini", "created_at": now, "is_default": False,
                      "credit_cost": 100, "access_level": 3},
                 ]
 
@@ -115,16 +178,22 @@ class MongoDBStore:
     # MEMORY METHODS - FIXED WITHOUT TRANSACTIONS
     # =====================================
 
-    def get_user_messages(self, user_id: int) -> List[Dict[str, str]]:
-        """Get user's conversation history - WITHOUT TRANSACTION"""
+    def get_user_messages(self, user_id: int, max_tokens: Optional[int] = None) -> List[Dict[str, str]]:
+        """
+        Get user's conversation history - WITHOUT TRANSACTION
+        When max_tokens is given, the oldest messages beyond that budget are left out
+        """
         try:
             # Direct query without transaction
             result = self.db[self.COLLECTIONS['memory']].find_one(
-                {"user_id": user_id}
+                {"user_id": user_id},
+                {"messages": 1, "token_counts": 1}
             )
 
             if result and "messages" in result:
                 messages = result["messages"]
+                if max_tokens is not None:
+                    messages = self._apply_memory_limits(messages, max_tokens, result.get("token_counts"))
                 logger.debug(f"Retrieved {len(messages)} messages for user {user_id}")
                 return messages
 
@@ -134,97 +203,163 @@ class MongoDBStore:
             logger.exception(f"Error getting messages for user {user_id}: {e}")
             return []
 
-    def add_message(self, user_id: int, message: Dict[str, str], max_messages: int = 25, max_tokens: int = 4000):
+    def add_message(self, user_id: int, message: Dict[str, str], max_messages: int = 25):
         """
         Add message to user's conversation history - WITHOUT TRANSACTION
-        Uses atomic operations to prevent race conditions
+        Uses a single atomic $push so MongoDB keeps only the last max_messages entries.
+        The token budget is applied when the history is read back (see get_user_messages).
         """
-        try:
-            current_time = datetime.utcnow()
+        return self.add_messages_bulk([(user_id, message)], max_messages)
 
-            # Get current messages without transaction
-            current_doc = self.db[self.COLLECTIONS['memory']].find_one(
-                {"user_id": user_id}
-            )
+    def add_messages_bulk(self, items: List[Tuple[int, Dict[str, str]]], max_messages: int = 25) -> bool:
+        """
+        Append several (user_id, message) pairs in one unordered bulk_write.
+        Messages for the same user are pushed together in their original order.
+        """
+        if not items:
+            return True
 
-            current_messages = current_doc.get("messages", []) if current_doc else []
+        user_ids = [user_id for user_id, _ in items]
+        try:
+            now = datetime.now(timezone.utc)
+            token_counts = self._count_tokens([message.get("content", "") for _, message in items])
+
+            pending: Dict[int, Tuple[List[Dict[str, str]], List[int]]] = {}
+            for (user_id, message), token_count in zip(items, token_counts):
+                messages, counts = pending.setdefault(user_id, ([], []))
+                messages.append(message)
+                counts.append(token_count)
+
+            # Atomic upserts without transaction - messages and token_counts stay aligned
+            operations = [
+                UpdateOne(
+                    {"user_id": user_id},
+                    {
+                        "$push": {
+                            "messages": {"$each": messages, "$slice": -max_messages},
+                            "token_counts": {"$each": counts, "$slice": -max_messages}
+                        },
+                        "$set": {
+                            "updated_at": now
+                        },
+                        "$setOnInsert": {
+                            "user_id": user_id,
+                            "created_at": now
+                        }
+                    },
+                    upsert=True
+                )
+                for user_id, (messages, counts) in pending.items()
+            ]
+            self.db[self.COLLECTIONS['memory']].bulk_write(operations, ordered=False)
 
-            # Add new message
-            updated_messages = current_messages + [message]
+            logger.info(f"Successfully added {len(items)} message(s) for user(s) {sorted(pending)}")
+            return True
 
-            # Apply limits
-            updated_messages = self._apply_memory_limits(updated_messages, max_messages, max_tokens)
+        except Exception as e:
+            logger.exception(f"Error adding messages for user(s) {sorted(set(user_ids))}: {e}")
+            return False
 
-            # Atomic upsert without transaction
-            result = self.db[self.COLLECTIONS['memory']].find_one_and_update(
+    def get_user_token_count(self, user_id: int, max_tokens: Optional[int] = None) -> int:
+        """
+        Get the token count of user's conversation history from the cached per-message counts
+        When max_tokens is given, only the messages kept by get_user_messages are counted
+        """
+        try:
+            result = self.db[self.COLLECTIONS['memory']].find_one(
                 {"user_id": user_id},
-                {
-                    "$set": {
-                        "messages": updated_messages,
-                        "updated_at": current_time,
-                        "message_count": len(updated_messages)
-                    },
-                    "$setOnInsert": {
-                        "user_id": user_id,
-                        "created_at": current_time
-                    }
-                },
-                upsert=True,
-                return_document=True
+                {"messages": 1, "token_counts": 1}
             )
+            if not result or not result.get("messages"):
+                return 0
 
-            logger.info(f"Successfully added message for user {user_id}. Total messages: {len(updated_messages)}")
-            return True
-
+            token_counts = self._align_token_counts(result["messages"], result.get("token_counts"))
+            if max_tokens is not None:
+                token_counts = token_counts[self._budget_cut(token_counts, max_tokens):]
+            return sum(token_counts)
         except Exception as e:
-            logger.exception(f"Error adding message for user {user_id}: {e}")
-            return False
+            logger.exception(f"Error getting token count for user {user_id}: {e}")
+            return 0
 
-    def _apply_memory_limits(self, messages: List[Dict[str, str]], max_messages: int, max_tokens: int) -> List[
-        Dict[str, str]]:
-        """Apply message count and token limits while preserving conversation flow"""
+    def _apply_memory_limits(self, messages: List[Dict[str, str]], max_tokens: int,
+                             token_counts: Optional[List[int]] = None) -> List[Dict[str, str]]:
+        """
+        Apply token limit while preserving conversation flow.
+        token_counts holds cached counts for the most recent messages; documents written
+        before counts were cached only have them for their newest entries.
+        """
         if not messages:
             return messages
 
-        # First apply message count limit
-        if len(messages) > max_messages:
-            # Keep the most recent messages
-            messages = messages[-max_messages:]
-
-        # Then apply token limit
-        total_tokens = 0
-        token_counts = []
-
-        # Calculate tokens for each message
-        for msg in messages:
+        token_counts = token_counts or []
+        missing = len(messages) - len(token_counts)
+        if missing > 0:
+            # Every token spans at least one UTF-8 byte, so the byte length is an upper
+            # bound on the token count - skip tokenization when that bound already fits
             try:
-                tokens = len(self.tokenizer.encode(msg.get("content", "")))
-                token_counts.append(tokens)
-                total_tokens += tokens
-            except Exception as e:
-                logger.warning(f"Error calculating tokens for message: {e}")
-                token_counts.append(100)  # Fallback estimate
-                total_tokens += 100
+                byte_bound = sum(len(msg.get("content", "").encode("utf-8")) for msg in messages[:missing])
+                if byte_bound + sum(token_counts) <= max_tokens:
+                    return messages
+            except (AttributeError, UnicodeEncodeError):
+                pass  # Non-text content, fall through to exact counting
 
-        # If over token limit, remove oldest messages
-        if total_tokens > max_tokens:
-            final_messages = []
-            current_tokens = 0
-
-            # Work backwards to keep most recent messages within token limit
-            for i in range(len(messages) - 1, -1, -1):
-                msg_tokens = token_counts[i]
-                if current_tokens + msg_tokens <= max_tokens:
-                    final_messages.insert(0, messages[i])
-                    current_tokens += msg_tokens
-                else:
-                    break
+        token_counts = self._align_token_counts(messages, token_counts)
 
+        # If over token limit, remove oldest messages
+        cut = self._budget_cut(token_counts, max_tokens)
+        if cut:
+            final_messages = messages[cut:]
             logger.debug(f"Trimmed messages from {len(messages)} to {len(final_messages)} due to token limit")
             return final_messages
 
         return messages
 
+    def _align_token_counts(self, messages: List[Dict[str, str]],
+                            token_counts: Optional[List[int]]) -> List[int]:
+        """Line cached token counts up with messages, counting any legacy prefix without one"""
+        token_counts = token_counts or []
+        missing = len(messages) - len(token_counts)
+        if missing < 0:
+            return token_counts[len(token_counts) - len(messages):]
+        if missing > 0:
+            contents = [msg.get("content", "") for msg in messages[:missing]]
+            return self._count_tokens(contents) + token_counts
+        return token_counts
+
+    @staticmethod
+    def _budget_cut(token_counts: List[int], max_tokens: int) -> int:
+        """Index of the earliest message whose suffix still fits in max_tokens"""
+        # Work backwards so the newest messages are kept
+        cut = len(token_counts)
+        running = 0
+        for i in range(len(token_counts) - 1, -1, -1):
+            running += token_counts[i]
+            if running > max_tokens:
+                break
+            cut = i
+        return cut
+
+    def _count_tokens(self, contents: List[str]) -> List[int]:
+        """Count tokens for each content string, batching large inputs"""
+        tokenizer = _get_tokenizer()
+        if tokenizer is None:
+            return [100] * len(contents)  # Fallback estimate
+        # Chat content never carries special tokens, so skip that scan
+        if len(contents) >= _BATCH_TOKENIZE_MIN:
+            try:
+                return [len(tokens) for tokens in tokenizer.encode_ordinary_batch(contents, num_threads=4)]
+            except Exception as e:
+                logger.warning(f"Batch token calculation failed, falling back to per-message: {e}")
+
+        token_counts = []
+        for content in contents:
+            try:
+                token_counts.append(len(tokenizer.encode_ordinary(content)))
+            except Exception as e:
+                logger.warning(f"Error calculating tokens for message: {e}")
+                token_counts.append(100)  # Fallback estimate
+        return token_counts
+
     def clear_user_memory(self, user_id: int) -> bool:
         """Clear user's conversation history - WITHOUT TRANSACTION"""
         try:
@@ -242,30 +377,14 @@ class MongoDBStore:
     def remove_last_message(self, user_id: int) -> bool:
         """Remove the last message from user's conversation history - WITHOUT TRANSACTION"""
         try:
-            # Get current messages without transaction
-            current_doc = self.db[self.COLLECTIONS['memory']].find_one(
-                {"user_id": user_id}
-            )
-
-            if not current_doc or "messages" not in current_doc:
-                return False
-
-            messages = current_doc["messages"]
-            if not messages:
-                return False
-
-            # Remove last message
-            messages = messages[:-1]
-
-            # Update document without transaction
+            now = datetime.now(timezone.utc)
+            # Pop server-side; the messages.0 guard makes an empty history report False.
+            # token_counts is popped too so the cached counts stay aligned with messages
             result = self.db[self.COLLECTIONS['memory']].update_one(
-                {"user_id": user_id},
+                {"user_id": user_id, "messages.0": {"$exists": True}},
                 {
-                    "$set": {
-                        "messages": messages,
-                        "updated_at": datetime.utcnow(),
-                        "message_count": len(messages)
-                    }
+                    "$pop": {"messages": 1, "token_counts": 1},
+                    "$set": {"updated_at": now}
                 }
             )
 
@@ -278,46 +397,69 @@ class MongoDBStore:
     # USER CONFIG METHODS
     # =====================================
 
+    def _invalidate_user_config(self, user_id: int):
+        """Drop a user's cached configuration"""
+        with self._config_cache_lock:
+            self._config_cache.pop(user_id, None)
+            self._config_reads.pop(user_id, None)
+
+    def _update_cached_credit(self, user_id: int, credit: int):
+        """Keep a cached configuration in step with a credit change"""
+        with self._config_cache_lock:
+            config = self._config_cache.get(user_id)
+            if config is not None:
+                config["credit"] = credit
+            self._config_reads.pop(user_id, None)
+
     def get_user_config(self, user_id: int) -> Dict[str, Any]:
         """Get user configuration"""
+        with self._config_cache_lock:
+            cached = self._config_cache.get(user_id)
+            if cached is None:
+                read_marker = object()
+                self._config_reads[user_id] = read_marker
+        if cached is not None:
+            return dict(cached)
+
         try:
             result = self.db[self.COLLECTIONS['user_config']].find_one({"user_id": user_id})
             if result:
-                user_model = result.get("model", "gemini-2.5-flash")
+                user_model = result.get("model", _DEFAULT_USER_CONFIG["model"])
                 if not self.model_exists(user_model):
                     supported_models = self.get_supported_models()
                     if supported_models:
                         user_model = next(iter(supported_models))
                         self.set_user_config(user_id, model=user_model)
                     else:
-                        user_model = "gemini-2.5-flash"
+                        user_model = _DEFAULT_USER_CONFIG["model"]
 
-                return {
+                config = {
                     "model": user_model,
-                    "system_prompt": result.get("system_prompt", "Tên của bạn là Ryuuko (nữ), nói tiếng việt"),
+                    "system_prompt": result.get("system_prompt", _DEFAULT_USER_CONFIG["system_prompt"]),
                     "credit": result.get("credit", 0),
                     "access_level": result.get("access_level", 0)
                 }
             else:
-                return {
-                    "model": "gemini-2.5-flash",
-                    "system_prompt": "Tên của bạn là Ryuuko (nữ), nói tiếng việt",
-                    "credit": 0,
-                    "access_level": 0
-                }
+                config = _DEFAULT_USER_CONFIG.copy()
+
+            with self._config_cache_lock:
+                # Skip caching if a write landed while the document was being read
+                if self._config_reads.get(user_id) is read_marker:
+                    self._config_cache[user_id] = config
+            return dict(config)
         except Exception as e:
             logger.exception(f"Error getting user config for {user_id}: {e}")
-            return {
-                "model": "gemini-2.5-flash",
-                "system_prompt": "Tên của bạn là Ryuuko (nữ), nói tiếng việt",
-                "credit": 0,
-                "access_level": 0
-            }
+            return _DEFAULT_USER_CONFIG.copy()
+        finally:
+            with self._config_cache_lock:
+                if self._config_reads.get(user_id) is read_marker:
+                    del self._config_reads[user_id]
 
     def set_user_config(self, user_id: int, model: Optional[str] = None, system_prompt: Optional[str] = None) -> bool:
         """Set user configuration"""
         try:
-            update_data = {"updated_at": datetime.utcnow()}
+            now = datetime.now(timezone.utc)
+            update_data = {"updated_at": now}
             if model is not None:
                 if not self.model_exists(model):
                     logger.warning(f"Attempt to set non-existent model {model} for user {user_id}")
@@ -326,48 +468,71 @@ class MongoDBStore:
             if system_prompt is not None:
                 update_data["system_prompt"] = system_prompt
 
-            result = self.db[self.COLLECTIONS['user_config']].update_one(
+            self.db[self.COLLECTIONS['user_config']].update_one(
                 {"user_id": user_id},
                 {
                     "$set": update_data,
                     "$setOnInsert": {
                         "user_id": user_id,
-                        "created_at": datetime.utcnow()
+                        "created_at": now
                     }
                 },
                 upsert=True
             )
+            self._invalidate_user_config(user_id)
             return True
         except Exception as e:
             logger.exception(f"Error setting user config for {user_id}: {e}")
             return False
 
-    def get_user_model(self, user_id: int) -> str:
-        """Get user's preferred model"""
-        config = self.get_user_config(user_id)
+    def get_user_model(self, user_id: int, config: Optional[Dict[str, Any]] = None) -> str:
+        """Get user's preferred model, reusing an already fetched config when given"""
+        if config is None:
+            config = self.get_user_config(user_id)
         return config["model"]
 
-    def get_user_system_prompt(self, user_id: int) -> str:
-        """Get user's system prompt"""
-        config = self.get_user_config(user_id)
+    def get_user_system_prompt(self, user_id: int, config: Optional[Dict[str, Any]] = None) -> str:
+        """Get user's system prompt, reusing an already fetched config when given"""
+        if config is None:
+            config = self.get_user_config(user_id)
         return config["system_prompt"]
 
-    def get_user_system_message(self, user_id: int) -> Dict[str, str]:
+    def get_user_system_message(self, user_id: int, config: Optional[Dict[str, Any]] = None) -> Dict[str, str]:
         """Get system message in OpenAI format"""
         return {
             "role": "system",
-            "content": self.get_user_system_prompt(user_id)
+            "content": self.get_user_system_prompt(user_id, config)
         }
 
     # =====================================
     # SUPPORTED MODELS METHODS
     # =====================================
 
+    def _supported_model_names(self) -> Set[str]:
+        """Get the cached set of supported model names, refreshing it when stale"""
+        # Read the cache once: an invalidation from another thread may reset it at any point
+        names = self._models_cache
+        if names is None or time.monotonic() - self._models_cache_ts > 60:
+            generation = self._models_cache_generation
+            results = self.db[self.COLLECTIONS['models']].find({}, {"model_name": 1, "_id": 0}).batch_size(1000)
+            names = {doc["model_name"] for doc in results}
+            with self._models_cache_lock:
+                # Skip caching if a model was added, removed or edited during the query
+                if self._models_cache_generation == generation:
+                    self._models_cache = names
+                    self._models_cache_ts = time.monotonic()
+        return names
+
+    def _invalidate_models_cache(self):
+        """Force the next model lookup to hit the database"""
+        with self._models_cache_lock:
+            self._models_cache = None
+            self._models_cache_generation += 1
+
     def get_supported_models(self) -> Set[str]:
         """Get set of supported model names"""
         try:
-            results = self.db[self.COLLECTIONS['models']].find({}, {"model_name": 1})
-            return {doc["model_name"] for doc in results}
+            return set(self._supported_model_names())
         except Exception as e:
             logger.exception(f"Error getting supported models: {e}")
             return {"gemini-2.5-flash", "gemini-2.5-pro", "gpt-3.5-turbo", "gpt-4o-mini"}
@@ -376,8 +541,7 @@ class MongoDBStore:
         """Check if a model exists in supported models"""
         try:
             # Check regular models only (removed pmodel check)
-            model = self.db[self.COLLECTIONS['models']].find_one({"model_name": model_name})
-            return model is not None
+            return model_name in self._supported_model_names()
 
         except Exception as e:
             logger.exception(f"Error checking if model {model_name} exists: {e}")
@@ -403,6 +567,7 @@ class MongoDBStore:
     def add_supported_model(self, model_name: str, credit_cost: int = 1, access_level: int = 0) -> tuple[bool, str]:
         """Add a new supported model"""
         try:
+            now = datetime.now(timezone.utc)
             model_name = model_name.strip()
             if not model_name:
                 return False, "Model name cannot be empty"
@@ -413,18 +578,19 @@ class MongoDBStore:
             if access_level not in [0, 1, 2]:
                 return False, "Access level must be 0, 1, 2"
 
-            existing = self.db[self.COLLECTIONS['models']].find_one({"model_name": model_name})
+            existing = self.db[self.COLLECTIONS['models']].find_one({"model_name": model_name}, {"_id": 1})
             if existing:
                 return False, f"Model '{model_name}' already exists"
 
             result = self.db[self.COLLECTIONS['models']].insert_one({
                 "model_name": model_name,
-                "created_at": datetime.utcnow(),
+                "created_at": now,
                 "is_default": False,
                 "credit_cost": credit_cost,
                 "access_level": access_level
             })
 
+            self._invalidate_models_cache()
             if result.inserted_id:
                 return True, f"Successfully added model '{model_name}' (Cost: {credit_cost}, Level: {access_level})"
             return False, "Failed to add model to database"
@@ -439,7 +605,7 @@ class MongoDBStore:
             if not model_name:
                 return False, "Model name cannot be empty"
 
-            existing = self.db[self.COLLECTIONS['models']].find_one({"model_name": model_name})
+            existing = self.db[self.COLLECTIONS['models']].find_one({"model_name": model_name}, {"is_default": 1})
             if not existing:
                 return False, f"Model '{model_name}' does not exist"
 
@@ -451,6 +617,7 @@ class MongoDBStore:
                 return False, f"Cannot remove model '{model_name}' - {users_using_model} user(s) are currently using it"
 
             result = self.db[self.COLLECTIONS['models']].delete_one({"model_name": model_name})
+            self._invalidate_models_cache()
 
             if result.deleted_count > 0:
                 return True, f"Successfully removed model '{model_name}'"
@@ -465,15 +632,16 @@ class MongoDBStore:
         bool, str]:
         """Edit an existing model's settings"""
         try:
+            now = datetime.now(timezone.utc)
             model_name = model_name.strip()
             if not model_name:
                 return False, "Model name cannot be empty"
 
-            existing = self.db[self.COLLECTIONS['models']].find_one({"model_name": model_name})
+            existing = self.db[self.COLLECTIONS['models']].find_one({"model_name": model_name}, {"_id": 1})
             if not existing:
                 return False, f"Model '{model_name}' does not exist"
 
-            update_data = {"updated_at": datetime.utcnow()}
+            update_data = {"updated_at": now}
             if credit_cost is not None:
                 if credit_cost < 0:
                     return False, "Credit cost cannot be negative"
@@ -488,6 +656,7 @@ class MongoDBStore:
                 {"model_name": model_name},
                 {"$set": update_data}
             )
+            self._invalidate_models_cache()
 
             if result.modified_count > 0:
                 return True, f"Successfully updated model '{model_name}'"
@@ -504,7 +673,7 @@ class MongoDBStore:
     def get_authorized_users(self) -> Set[int]:
         """Get set of authorized user IDs"""
         try:
-            results = self.db[self.COLLECTIONS['authorized']].find({}, {"user_id": 1})
+            results = self.db[self.COLLECTIONS['authorized']].find({}, {"user_id": 1, "_id": 0}).batch_size(1000)
             return {doc["user_id"] for doc in results}
         except Exception as e:
             logger.exception(f"Error getting authorized users: {e}")
@@ -513,12 +682,13 @@ class MongoDBStore:
     def add_authorized_user(self, user_id: int) -> bool:
         """Add user to authorized list"""
         try:
-            result = self.db[self.COLLECTIONS['authorized']].update_one(
+            now = datetime.now(timezone.utc)
+            self.db[self.COLLECTIONS['authorized']].update_one(
                 {"user_id": user_id},
                 {
                     "$setOnInsert": {
                         "user_id": user_id,
-                        "created_at": datetime.utcnow()
+                        "created_at": now
                     }
                 },
                 upsert=True
@@ -540,8 +710,7 @@ class MongoDBStore:
     def is_user_authorized(self, user_id: int) -> bool:
         """Check if user is authorized"""
         try:
-            result = self.db[self.COLLECTIONS['authorized']].find_one({"user_id": user_id})
-            return result is not None
+            return self.db[self.COLLECTIONS['authorized']].count_documents({"user_id": user_id}, limit=1) > 0
         except Exception as e:
             logger.exception(f"Error checking authorization for user {user_id}: {e}")
             return False
@@ -553,23 +722,25 @@ class MongoDBStore:
     def set_user_level(self, user_id: int, level: int) -> bool:
         """Set user access level"""
         try:
+            now = datetime.now(timezone.utc)
             if level not in [0, 1, 2, 3]:
                 return False
 
-            result = self.db[self.COLLECTIONS['user_config']].update_one(
+            self.db[self.COLLECTIONS['user_config']].update_one(
                 {"user_id": user_id},
                 {
                     "$set": {
                         "access_level": level,
-                        "updated_at": datetime.utcnow()
+                        "updated_at": now
                     },
                     "$setOnInsert": {
                         "user_id": user_id,
-                        "created_at": datetime.utcnow()
+                        "created_at": now
                     }
                 },
                 upsert=True
             )
+            self._invalidate_user_config(user_id)
             return True
         except Exception as e:
             logger.exception(f"Error setting level for user {user_id}: {e}")
@@ -578,21 +749,24 @@ class MongoDBStore:
     def add_user_credit(self, user_id: int, amount: int) -> tuple[bool, int]:
         """Add credit to user balance"""
         try:
+            now = datetime.now(timezone.utc)
             result = self.db[self.COLLECTIONS['user_config']].find_one_and_update(
                 {"user_id": user_id},
                 {
                     "$inc": {"credit": amount},
                     "$setOnInsert": {
                         "user_id": user_id,
-                        "created_at": datetime.utcnow()
+                        "created_at": now
                     },
                     "$set": {
-                        "updated_at": datetime.utcnow()
+                        "updated_at": now
                     }
                 },
+                projection={"credit": 1},
                 upsert=True,
                 return_document=True
             )
+            self._update_cached_credit(user_id, result.get("credit", 0))
             return True, result.get("credit", 0)
         except Exception as e:
             logger.exception(f"Error adding credit for user {user_id}: {e}")
@@ -601,13 +775,8 @@ class MongoDBStore:
     def deduct_user_credit(self, user_id: int, amount: int) -> tuple[bool, int]:
         """Deduct credit from user balance"""
         try:
-            # First check if user has enough credit
-            user_config = self.get_user_config(user_id)
-            current_credit = user_config.get("credit", 0)
-
-            if current_credit < amount:
-                return False, current_credit
-
+            now = datetime.now(timezone.utc)
+            # The filter only matches when the balance covers the amount
             result = self.db[self.COLLECTIONS['user_config']].find_one_and_update(
                 {
                     "user_id": user_id,
@@ -616,15 +785,20 @@ class MongoDBStore:
                 {
                     "$inc": {"credit": -amount},
                     "$set": {
-                        "updated_at": datetime.utcnow()
+                        "updated_at": now
                     }
                 },
+                projection={"credit": 1},
                 return_document=True
             )
 
             if result:
+                self._update_cached_credit(user_id, result.get("credit", 0))
                 return True, result.get("credit", 0)
-            return False, current_credit
+
+            # Insufficient credit (or unknown user) - report the current balance
+            current = self.db[self.COLLECTIONS['user_config']].find_one({"user_id": user_id}, {"credit": 1})
+            return False, current.get("credit", 0) if current else 0
 
         except Exception as e:
             logger.exception(f"Error deducting credit for user {user_id}: {e}")
@@ -633,6 +807,7 @@ class MongoDBStore:
     def set_user_credit(self, user_id: int, amount: int) -> bool:
         """Set user's credit balance to a specific amount"""
         try:
+            now = datetime.now(timezone.utc)
             if amount < 0:
                 return False
 
@@ -641,15 +816,16 @@ class MongoDBStore:
                 {
                     "$set": {
                         "credit": amount,
-                        "updated_at": datetime.utcnow()
+                        "updated_at": now
                     },
                     "$setOnInsert": {
                         "user_id": user_id,
-                        "created_at": datetime.utcnow()
+                        "created_at": now
                     }
                 },
                 upsert=True
             )
+            self._update_cached_credit(user_id, amount)
             return result.modified_count > 0 or result.upserted_id is not None
 
         except Exception as e:
@@ -670,8 +846,8 @@ class MongoDBStore:
         try:
             results = self.db[self.COLLECTIONS['user_config']].find(
                 {"model": model_name},
-                {"user_id": 1}
-            )
+                {"user_id": 1, "_id": 0}
+            ).batch_size(1000)
             return [doc["user_id"] for doc in results]
         except Exception as e:
             logger.exception(f"Error getting users for model {model_name}: {e}")
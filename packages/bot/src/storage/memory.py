@@ -1,5 +1,4 @@
 # src/storage/memory.py
-import tiktoken
 import logging
 from typing import List, Dict
 from bot.config import loader
@@ -7,11 +6,6 @@ from bot.storage.database import MongoDBStore
 
 logger = logging.getLogger("Storage.Memory")
 
-try:
-    TOKENIZER = tiktoken.encoding_for_model("gpt-4")
-except Exception:
-    TOKENIZER = tiktoken.get_encoding("cl100k_base")
-
 
 class Msg(Dict):
     role: str
@@ -31,9 +25,10 @@ class MemoryStore:
         logger.info("MemoryStore initialized with MongoDB backend.")
 
     def get_user_messages(self, user_id: int) -> List[Msg]:
-        """Get user's conversation history from MongoDB."""
+        """Get user's conversation history from MongoDB, trimmed to the token budget."""
         try:
-            return self.mongo_store.get_user_messages(user_id)
+            max_tokens = getattr(loader, 'MEMORY_MAX_TOKENS', 4000)
+            return self.mongo_store.get_user_messages(user_id, max_tokens)
         except Exception as e:
             logger.exception(f"Error getting messages from MongoDB for user {user_id}: {e}")
             return []
@@ -43,12 +38,20 @@ class MemoryStore:
         try:
             # Lấy cấu hình giới hạn từ loader
             max_messages = getattr(loader, 'MEMORY_MAX_MESSAGES', 25)
-            max_tokens = getattr(loader, 'MEMORY_MAX_TOKENS', 4000)
-            return self.mongo_store.add_message(user_id, msg, max_messages, max_tokens)
+            return self.mongo_store.add_message(user_id, msg, max_messages)
         except Exception as e:
             logger.exception(f"Error adding message to MongoDB for user {user_id}: {e}")
             return False
 
+    def add_messages(self, user_id: int, msgs: List[Msg]) -> bool:
+        """Add several messages to user's conversation history in one MongoDB write."""
+        try:
+            max_messages = getattr(loader, 'MEMORY_MAX_MESSAGES', 25)
+            return self.mongo_store.add_messages_bulk([(user_id, msg) for msg in msgs], max_messages)
+        except Exception as e:
+            logger.exception(f"Error adding messages to MongoDB for user {user_id}: {e}")
+            return False
+
     def clear_user_messages(self, user_id: int) -> bool:
         """
         Clears the conversation history for a specific user in MongoDB.
@@ -76,6 +79,10 @@ class MemoryStore:
         return len(self.get_user_messages(user_id))
 
     def get_token_count(self, user_id: int) -> int:
-        """Get approximate token count for user's messages from MongoDB."""
-        messages = self.get_user_messages(user_id)
-        return sum(len(TOKENIZER.encode(msg.get("content", ""))) for msg in messages)
\ No newline at end of file
+        """Get token count for user's messages from the counts cached in MongoDB."""
+        try:
+            max_tokens = getattr(loader, 'MEMORY_MAX_TOKENS', 4000)
+            return self.mongo_store.get_user_token_count(user_id, max_tokens)
+        except Exception as e:
+            logger.exception(f"Error getting token count from MongoDB for user {user_id}: {e}")
+            return 0
\ No newline at end of file
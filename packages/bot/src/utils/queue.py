@@ -3,57 +3,125 @@
 # queue.py - Request queue system with owner priority handling
 
 import asyncio
+import heapq
 import logging
+import sys
 import time
-from dataclasses import dataclass
-from typing import Optional, Dict, Set
+from dataclasses import dataclass, field
+from typing import ClassVar, Optional, Dict, List, FrozenSet, Tuple
 import discord
 
 logger = logging.getLogger("Request Queue")
 
-@dataclass
+# Per-user token bucket: short bursts up to the capacity, one request per 3s sustained
+RATE_LIMIT_CAPACITY = 3.0
+RATE_LIMIT_REFILL_RATE = 1 / 3.0  # Tokens per second
+# Idle buckets refill completely after CAPACITY / REFILL_RATE seconds, so dropping them
+# later than that changes nothing; sweep once the table grows past the threshold
+RATE_LIMIT_IDLE_SECONDS = 300.0
+RATE_LIMIT_SWEEP_THRESHOLD = 1024
+
+# Upper bound on pending requests; callers get a "server busy" reply instead of an
+# ever-growing backlog when the worker falls behind
+MAX_QUEUE_SIZE = 256
+
+# Prompt text kept per queued request; Discord messages are far below this, so it only
+# bounds what a queued entry can hold. Short texts are interned to share common messages
+MAX_PROMPT = 8192
+INTERN_MAX_LENGTH = 64
+
+# Worker restart delay after an unexpected error, doubled on each consecutive failure
+WORKER_BACKOFF_INITIAL = 1.0
+WORKER_BACKOFF_MAX = 30.0
+
+# Requests of the same user allowed to be processed at once
+MAX_INFLIGHT_PER_USER = 1
+
+@dataclass(eq=False, slots=True)
 class QueuedRequest:
     """Represent a queued AI request"""
+    # Priority aging: each second of waiting is worth this much of a priority class,
+    # so a non-owner request overtakes owner requests submitted 100s after it
+    AGE_WEIGHT: ClassVar[float] = 0.01
+
     message: discord.Message
     user_id: int
     is_owner: bool
     timestamp: float
     final_user_text: str
-    
-    def __lt__(self, other):
+    cancelled: bool = field(default=False, init=False)
+    _key: Tuple[int, float] = field(init=False, repr=False)
+
+    def __post_init__(self):
         # Owner requests have higher priority (lower number = higher priority)
         # If same priority level, earlier timestamp wins
-        if self.is_owner != other.is_owner:
-            return self.is_owner  # True < False, so owner goes first
-        return self.timestamp < other.timestamp
+        # The aged priority class - AGE_WEIGHT * (now - timestamp) shifts every entry by
+        # the same amount as time passes, so the ordering only depends on
+        # class + AGE_WEIGHT * timestamp and the heap never needs re-sorting
+        priority = (0 if self.is_owner else 1) + self.AGE_WEIGHT * self.timestamp
+        self._key = (priority, self.timestamp)
+
+    def __lt__(self, other):
+        return self._key < other._key
 
 class RequestQueue:
     """Request queue system for AI processing with owner priority"""
     
     def __init__(self):
-        self._queue = None  # Will be lazy initialized when needed
-        self._processing_users: Set[int] = set()
-        self._user_last_request: Dict[int, float] = {}  # Rate limiting
+        # Priority heap plus a single wake-up event for the worker
+        self._heap: List[QueuedRequest] = []
+        self._not_empty = asyncio.Event()
+        self._inflight: Dict[int, int] = {}  # user_id -> requests being processed
+        self._by_user: Dict[int, QueuedRequest] = {}  # Pending request of each queued user
+        self._buckets: Dict[int, Tuple[float, float]] = {}  # Rate limiting: user_id -> (tokens, last_refill)
         self._is_processing = False
         self._worker_task: Optional[asyncio.Task] = None
         
         # Callbacks
         self._process_callback = None
         self._bot = None
+        self._owner_ids: Optional[FrozenSet[int]] = None  # Resolved lazily from the bot
     
-    def _ensure_queue_initialized(self):
-        """Lazy initialization của queue để tránh event loop issues"""
-        if self._queue is None:
-            try:
-                self._queue = asyncio.PriorityQueue()
-            except RuntimeError:
-                # Nếu chưa có event loop, thử tạo một cái mới
-                loop = asyncio.get_event_loop()
-                self._queue = asyncio.PriorityQueue()
+    def _put(self, request: QueuedRequest):
+        """Push a request onto the heap and wake the worker"""
+        heapq.heappush(self._heap, request)
+        self._not_empty.set()
+
+    async def _get(self) -> QueuedRequest:
+        """Pop the highest priority request, waiting until one is available"""
+        while not self._heap:
+            self._not_empty.clear()
+            await self._not_empty.wait()
+        return heapq.heappop(self._heap)
     
     def set_bot(self, bot):
         """Set bot instance for owner checking"""
         self._bot = bot
+        self._owner_ids = None
+
+    def invalidate_owner_ids(self):
+        """Forget the cached owner IDs so they are resolved again on next use"""
+        self._owner_ids = None
+
+    async def _get_owner_ids(self, user: discord.abc.User) -> FrozenSet[int]:
+        """Resolve the bot owner IDs once and cache them"""
+        if self._owner_ids is not None:
+            return self._owner_ids
+        if self._bot is None:
+            return frozenset()
+        try:
+            # Bot.is_owner fetches the application info when no owner is configured and
+            # fills owner_id / owner_ids, applying discord.py's own team member rules
+            if not (self._bot.owner_id or self._bot.owner_ids):
+                await self._bot.is_owner(user)
+            owner_ids = set(self._bot.owner_ids or ())
+            if self._bot.owner_id is not None:
+                owner_ids.add(self._bot.owner_id)
+            self._owner_ids = frozenset(owner_ids)
+            return self._owner_ids
+        except Exception:
+            logger.exception("Failed to resolve bot owner IDs")
+            return frozenset()
     
     def set_process_callback(self, callback):
         """Set callback function to process requests"""
@@ -61,60 +129,44 @@ class RequestQueue:
     
     async def is_owner(self, user: discord.abc.User) -> bool:
         """Check if user is bot owner"""
-        if self._bot is None:
-            return False
-        try:
-            return await self._bot.is_owner(user)
-        except Exception:
-            return False
+        return user.id in await self._get_owner_ids(user)
     
     # Replace the add_request method in queue.py
 
     # Replace the add_request method in queue.py with this fixed version:
 
-    async def add_request(self, message: discord.Message, final_user_text: str) -> tuple[bool, str]:
+    async def add_request(self, message: discord.Message, final_user_text: str, *,
+                          is_owner: Optional[bool] = None) -> tuple[bool, str]:
         """
         Add a request to queue - FIXED VERSION
+        is_owner: owner flag if the caller already resolved it, looked up otherwise
         Returns: (success: bool, message: str)
         """
-        self._ensure_queue_initialized()
-        
         user_id = message.author.id
-        current_time = time.time()
+        current_time = time.monotonic()
         
         # Check if user already has a request being processed
-        if user_id in self._processing_users:
+        if self._inflight.get(user_id, 0) >= MAX_INFLIGHT_PER_USER:
             return False, "⏳ You have a request being processed. Please wait for it to complete."
         
-        # Check if user already has requests in queue - IMPROVED CHECK
-        user_has_queued_request = False
-        temp_queue_items = []
-        
-        # Drain the queue to check for existing user requests
-        while not self._queue.empty():
-            try:
-                item = self._queue.get_nowait()
-                temp_queue_items.append(item)
-                if item.user_id == user_id:
-                    user_has_queued_request = True
-            except asyncio.QueueEmpty:
-                break
-        
-        # Put all items back in the queue
-        for item in temp_queue_items:
-            await self._queue.put(item)
-        
-        if user_has_queued_request:
+        # Check if user already has requests in queue
+        if user_id in self._by_user:
             return False, "⏳ You already have a request in queue. Please wait."
         
         # Rate limiting (except for owner)
-        is_owner = await self.is_owner(message.author)
+        if is_owner is None:
+            is_owner = user_id in (self._owner_ids or await self._get_owner_ids(message.author))
         if not is_owner:
-            last_request = self._user_last_request.get(user_id, 0)
-            if current_time - last_request < 3.0:  # Reduced to 3 seconds for faster testing
-                remaining = 3.0 - (current_time - last_request)
+            tokens, last_refill = self._buckets.get(user_id, (RATE_LIMIT_CAPACITY, current_time))
+            tokens = min(RATE_LIMIT_CAPACITY, tokens + RATE_LIMIT_REFILL_RATE * (current_time - last_refill))
+            if tokens < 1:
+                remaining = (1 - tokens) / RATE_LIMIT_REFILL_RATE
                 return False, f"⏰ Please wait {remaining:.1f}s before sending another request."
         
+        final_user_text = final_user_text[:MAX_PROMPT]
+        if len(final_user_text) < INTERN_MAX_LENGTH:
+            final_user_text = sys.intern(final_user_text)
+        
         # Create request with EXACT text from the current message
         request = QueuedRequest(
             message=message,
@@ -124,32 +176,56 @@ class RequestQueue:
             final_user_text=final_user_text  # Make sure this is the CURRENT request text
         )
         
-        # Log the request being added
-        logger.info(f"Adding request to queue for user {user_id}: {final_user_text[:100]}")
-        
-        # Add to queue
-        await self._queue.put(request)
-        self._user_last_request[user_id] = current_time
+        # Add to queue - re-check since the awaits above may have let another request
+        # from the same user through; nothing below awaits, so check and put are atomic
+        if user_id in self._by_user:
+            return False, "⏳ You already have a request in queue. Please wait."
+        # Count live entries only - cancelled requests linger in the heap until popped
+        if len(self._by_user) >= MAX_QUEUE_SIZE:
+            logger.warning(f"Queue full ({MAX_QUEUE_SIZE}), rejecting request from user {user_id}")
+            return False, "⏳ Server is busy, try again in a moment."
+        self._by_user[user_id] = request
+        self._put(request)
+        # Log the request once it is actually queued
+        if logger.isEnabledFor(logging.INFO):
+            logger.info("Adding request to queue for user %s: %.100s", user_id, final_user_text)
+        if not is_owner:
+            self._buckets[user_id] = (tokens - 1, current_time)
         
         # Start worker if not running
         if self._worker_task is None or self._worker_task.done():
             self._worker_task = asyncio.create_task(self._worker())
         
         return True, None
+
+    def cancel_user_request(self, user_id: int) -> bool:
+        """
+        Cancel the pending request of a user
+        Returns: True if a queued request was cancelled
+        """
+        request = self._by_user.pop(user_id, None)
+        if request is None:
+            return False
+        # The entry stays in the heap and is skipped by the worker when popped
+        request.cancelled = True
+        logger.info(f"Cancelled queued request for user {user_id}")
+        return True
+
     async def _worker(self):
         """Background worker to process queued requests"""
         logger.info("Request queue worker started")
+        backoff = WORKER_BACKOFF_INITIAL
         
         while True:
             try:
-                # Đảm bảo queue được khởi tạo
-                self._ensure_queue_initialized()
-                
                 # Get next request (this will block until available)
-                request = await self._queue.get()
+                request = await self._get()
+                if request.cancelled:
+                    continue
                 
                 # Mark user as being processed
-                self._processing_users.add(request.user_id)
+                self._by_user.pop(request.user_id, None)
+                self._inflight[request.user_id] = self._inflight.get(request.user_id, 0) + 1
                 
                 try:
                     # Process the request
@@ -168,17 +244,36 @@ class RequestQueue:
                         logger.exception("Failed to send error message")
                 
                 finally:
-                    # Always remove user from processing set
-                    self._processing_users.discard(request.user_id)
-                    self._queue.task_done()
+                    # Always release the user's in-flight slot, dropping the entry at zero
+                    remaining = self._inflight.get(request.user_id, 0) - 1
+                    if remaining > 0:
+                        self._inflight[request.user_id] = remaining
+                    else:
+                        self._inflight.pop(request.user_id, None)
+
+                if len(self._buckets) > RATE_LIMIT_SWEEP_THRESHOLD:
+                    self._evict_stale_buckets()
+
+                backoff = WORKER_BACKOFF_INITIAL
                 
             except asyncio.CancelledError:
                 logger.info("Request queue worker cancelled")
                 break
             except Exception:
-                logger.exception("Unexpected error in request queue worker")
-                await asyncio.sleep(1)  # Prevent tight loop on persistent errors
+                logger.exception(f"Unexpected error in request queue worker, retrying in {backoff:.0f}s")
+                await asyncio.sleep(backoff)  # Prevent tight loop on persistent errors
+                backoff = min(backoff * 2, WORKER_BACKOFF_MAX)
     
+    def _evict_stale_buckets(self):
+        """Drop rate-limit buckets of users who have been idle for a while"""
+        now = time.monotonic()
+        stale = [user_id for user_id, (_, last_refill) in self._buckets.items()
+                 if now - last_refill > RATE_LIMIT_IDLE_SECONDS]
+        for user_id in stale:
+            del self._buckets[user_id]
+        if stale:
+            logger.debug(f"Evicted {len(stale)} idle rate-limit entries")
+
     async def stop(self):
         """Stop the queue worker"""
         logger.info("Stopping request queue...")
@@ -190,26 +285,22 @@ class RequestQueue:
             except asyncio.CancelledError:
                 logger.info("Worker task cancelled successfully")
         
-        # Clear processing users
-        self._processing_users.clear()
+        # Clear processing and queued users
+        self._inflight.clear()
+        self._by_user.clear()
         
-        # Clear remaining queue items if any
-        if self._queue is not None:
-            while not self._queue.empty():
-                try:
-                    self._queue.get_nowait()
-                    self._queue.task_done()
-                except asyncio.QueueEmpty:
-                    break
+        # Drop remaining queue items in one bulk operation
+        dropped = len(self._heap)
+        self._heap.clear()
+        self._not_empty.clear()
+        if dropped:
+            logger.warning(f"Dropped {dropped} pending request(s) on shutdown")
         
         logger.info("Request queue stopped")
 
-# Singleton instance
-_request_queue = None
+# Singleton instance - created at import, RequestQueue() does not touch the event loop
+_request_queue = RequestQueue()
 
 def get_request_queue() -> RequestQueue:
     """Get singleton instance of RequestQueue"""
-    global _request_queue
-    if _request_queue is None:
-        _request_queue = RequestQueue()
     return _request_queue
\ No newline at end of file
@@ -38,7 +38,7 @@ def mock_dependencies():
     """Fixture for the dictionary of mocked dependencies with accurate async/sync methods."""
     # Create a more specific mock for the request queue
     request_queue = Mock()
-    request_queue.add_request = AsyncMock()  # This method is async
+    request_queue.add_request = AsyncMock(return_value=(True, None))  # This method is async
     request_queue.set_process_callback = Mock() # This method is sync
 
     return {
@@ -107,7 +107,19 @@ class TestOnMessageListener:
         setup_message_events(mock_bot, mock_dependencies)
         on_message_callback = mock_bot.listeners['on_message']
         await on_message_callback(mock_message)
-        mock_dependencies['request_queue'].add_request.assert_called_once_with(mock_message, "Hello bot")
+        mock_dependencies['request_queue'].add_request.assert_called_once_with(mock_message, "Hello bot", is_owner=False)
+        mock_message.channel.send.assert_not_called()
+
+    async def test_reports_queue_rejection(self, mock_bot, mock_dependencies, mock_message):
+        mock_bot.get_context.return_value.valid = False
+        mock_message.mentions = [mock_bot.user]
+        mock_message.content = f"<@!{mock_bot.user.id}> Hello bot"
+        busy = "⏳ Server is busy, try again in a moment."
+        mock_dependencies['request_queue'].add_request.return_value = (False, busy)
+        setup_message_events(mock_bot, mock_dependencies)
+        on_message_callback = mock_bot.listeners['on_message']
+        await on_message_callback(mock_message)
+        mock_message.channel.send.assert_called_once_with(busy, reference=mock_message)
 
 @pytest.mark.asyncio
 class TestProcessAIRequest:
@@ -143,13 +155,18 @@ class TestProcessAIRequest:
 
         await process_callback(mock_request)
 
+        ucm.get_user_config.assert_called_once_with(AUTHORIZED_USER_ID)
+        ucm.get_user_model.assert_called_once_with(AUTHORIZED_USER_ID, ucm.get_user_config.return_value)
         api.call_unified_api.assert_called_once()
         mock_send_long.assert_called_once_with(
             mock_request.message.channel,
             "This is the AI response.",
             mock_request.message
         )
-        assert memory.add_message.call_count == 2
+        memory.add_messages.assert_called_once_with(AUTHORIZED_USER_ID, [
+            {"role": "user", "content": "This is a test prompt."},
+            {"role": "assistant", "content": "This is the AI response."}
+        ])
         mongo.deduct_user_credit.assert_called_once_with(AUTHORIZED_USER_ID, 10)
 
     @patch('bot.events.messages._read_attachments_enhanced', new_callable=AsyncMock)
@@ -0,0 +1,244 @@
+# tests/storage/test_database.py
+"""
+Test suite for the conversation memory and the config and model caches of MongoDBStore.
+"""
+
+import pytest
+from unittest.mock import Mock, MagicMock, patch
+
+from bot.storage import database
+from bot.storage.database import MongoDBStore
+
+USER_ID = 12345
+
+# --- Fixtures ---
+
+@pytest.fixture
+def tokenizer():
+    """Stub tokenizer that counts one token per whitespace-separated word."""
+    stub = Mock()
+    stub.encode_ordinary_batch = Mock(side_effect=lambda contents, num_threads=1: [c.split() for c in contents])
+    stub.encode_ordinary = Mock(side_effect=lambda content: content.split())
+    with patch.object(database, "_get_tokenizer", return_value=stub):
+        yield stub
+
+@pytest.fixture
+def store(tokenizer):
+    """MongoDBStore with the connection skipped and a mocked database."""
+    with patch.object(MongoDBStore, "_connect"), patch.object(MongoDBStore, "_initialize_default_models"):
+        store = MongoDBStore("mongodb://localhost")
+    store.db = MagicMock()
+    return store
+
+def make_messages(*contents):
+    return [{"role": "user", "content": content} for content in contents]
+
+# --- Tests ---
+
+class TestApplyMemoryLimits:
+    """Tests for trimming history to a token budget."""
+
+    def test_keeps_everything_within_budget(self, store, tokenizer):
+        messages = make_messages("a b", "c d")
+        result = store._apply_memory_limits(messages, 10, [2, 2])
+        assert result == messages
+        tokenizer.encode_ordinary.assert_not_called()
+
+    def test_keeps_newest_suffix_that_fits(self, store):
+        messages = make_messages("one", "two", "three", "four")
+        result = store._apply_memory_limits(messages, 5, [3, 1, 2, 2])
+        assert result == messages[1:]
+
+    def test_drops_everything_when_last_message_is_over_budget(self, store):
+        messages = make_messages("a", "b")
+        assert store._apply_memory_limits(messages, 5, [1, 6]) == []
+
+    def test_uses_newest_counts_when_counts_outnumber_messages(self, store, tokenizer):
+        messages = make_messages("x", "y")
+        # Stale leading counts must be ignored, only the last two line up with the messages
+        result = store._apply_memory_limits(messages, 4, [50, 50, 3, 1])
+        assert result == messages
+        tokenizer.encode_ordinary.assert_not_called()
+
+    def test_legacy_prefix_within_byte_bound_skips_tokenizer(self, store, tokenizer):
+        messages = make_messages("old", "new")
+        result = store._apply_memory_limits(messages, 10, [1])
+        assert result == messages
+        tokenizer.encode_ordinary.assert_not_called()
+
+    def test_legacy_prefix_is_tokenized_when_byte_bound_exceeds_budget(self, store, tokenizer):
+        messages = make_messages("w " * 6, "a b c", "d e")
+        result = store._apply_memory_limits(messages, 6, [2])
+        # Only the messages without a cached count are tokenized
+        assert [c.args[0] for c in tokenizer.encode_ordinary.call_args_list] == ["w " * 6, "a b c"]
+        assert result == messages[1:]
+
+    def test_large_legacy_prefix_is_tokenized_in_one_batch(self, store, tokenizer):
+        messages = make_messages(*["a b c"] * database._BATCH_TOKENIZE_MIN)
+        result = store._apply_memory_limits(messages, 6, None)
+        tokenizer.encode_ordinary_batch.assert_called_once()
+        tokenizer.encode_ordinary.assert_not_called()
+        assert result == messages[-2:]
+
+    def test_no_counts_at_all(self, store, tokenizer):
+        messages = make_messages("a b c d", "e f")
+        result = store._apply_memory_limits(messages, 3, None)
+        assert result == messages[1:]
+
+
+class TestGetUserMessages:
+    """Tests for reading history from the memory collection."""
+
+    def test_applies_budget_with_cached_counts(self, store):
+        messages = make_messages("a", "b", "c")
+        collection = store.db[store.COLLECTIONS['memory']]
+        collection.find_one.return_value = {"messages": messages, "token_counts": [4, 2, 2]}
+
+        result = store.get_user_messages(USER_ID, max_tokens=4)
+
+        assert result == messages[1:]
+        collection.find_one.assert_called_once_with(
+            {"user_id": USER_ID}, {"messages": 1, "token_counts": 1}
+        )
+
+    def test_without_budget_returns_all_messages(self, store, tokenizer):
+        messages = make_messages("a", "b")
+        store.db[store.COLLECTIONS['memory']].find_one.return_value = {"messages": messages}
+
+        assert store.get_user_messages(USER_ID) == messages
+        tokenizer.encode_ordinary.assert_not_called()
+
+    def test_missing_document_returns_empty_list(self, store):
+        store.db[store.COLLECTIONS['memory']].find_one.return_value = None
+        assert store.get_user_messages(USER_ID, max_tokens=100) == []
+
+
+class TestAddMessagesBulk:
+    """Tests for appending messages together with their token counts."""
+
+    def test_pushes_messages_and_counts_in_one_write(self, store):
+        collection = store.db[store.COLLECTIONS['memory']]
+        first = {"role": "user", "content": "hello there"}
+        second = {"role": "assistant", "content": "hi"}
+
+        assert store.add_messages_bulk([(USER_ID, first), (USER_ID, second)], max_messages=10) is True
+
+        collection.bulk_write.assert_called_once()
+        operations = collection.bulk_write.call_args.args[0]
+        assert len(operations) == 1
+        push = operations[0]._doc["$push"]
+        assert push["messages"] == {"$each": [first, second], "$slice": -10}
+        assert push["token_counts"] == {"$each": [2, 1], "$slice": -10}
+
+
+class TestGetUserTokenCount:
+    """Tests for reading the token count from cached per-message counts."""
+
+    def test_sums_cached_counts(self, store, tokenizer):
+        store.db[store.COLLECTIONS['memory']].find_one.return_value = {
+            "messages": make_messages("a", "b"), "token_counts": [3, 4]
+        }
+        assert store.get_user_token_count(USER_ID) == 7
+        tokenizer.encode_ordinary.assert_not_called()
+
+    def test_counts_only_messages_within_budget(self, store):
+        store.db[store.COLLECTIONS['memory']].find_one.return_value = {
+            "messages": make_messages("a", "b", "c"), "token_counts": [5, 2, 3]
+        }
+        assert store.get_user_token_count(USER_ID, max_tokens=6) == 5
+
+    def test_counts_legacy_prefix(self, store):
+        store.db[store.COLLECTIONS['memory']].find_one.return_value = {
+            "messages": make_messages("one two three", "b"), "token_counts": [1]
+        }
+        assert store.get_user_token_count(USER_ID) == 4
+
+    def test_missing_document_counts_zero(self, store):
+        store.db[store.COLLECTIONS['memory']].find_one.return_value = None
+        assert store.get_user_token_count(USER_ID) == 0
+
+
+class TestTokenizerUnavailable:
+    """Tests for falling back to estimates when the encoding cannot be loaded."""
+
+    @pytest.fixture
+    def offline(self, monkeypatch):
+        """Make every encoding load fail, as without network access to the BPE files."""
+        load = Mock(side_effect=OSError("no network"))
+        monkeypatch.setattr(database.tiktoken, "encoding_for_model", load)
+        monkeypatch.setattr(database.tiktoken, "get_encoding", load)
+        monkeypatch.setattr(database, "_TOKENIZER", None)
+        monkeypatch.setattr(database, "_tokenizer_failed_at", None)
+        return load
+
+    def test_messages_are_saved_with_estimated_counts(self, offline):
+        with patch.object(MongoDBStore, "_connect"), patch.object(MongoDBStore, "_initialize_default_models"):
+            store = MongoDBStore("mongodb://localhost")
+        store.db = MagicMock()
+
+        assert store.add_messages_bulk([(USER_ID, {"role": "user", "content": "hi"})]) is True
+        operations = store.db[store.COLLECTIONS['memory']].bulk_write.call_args.args[0]
+        assert operations[0]._doc["$push"]["token_counts"]["$each"] == [100]
+
+    def test_failed_load_is_not_retried_immediately(self, offline):
+        assert database._get_tokenizer() is None
+        calls = offline.call_count
+        assert database._get_tokenizer() is None
+        assert offline.call_count == calls
+
+
+class TestUserConfigCache:
+    """Tests for the short-lived user config cache."""
+
+    def test_second_read_is_served_from_cache(self, store):
+        collection = store.db[store.COLLECTIONS['user_config']]
+        collection.find_one.return_value = {"user_id": USER_ID, "credit": 100}
+
+        assert store.get_user_config(USER_ID)["credit"] == 100
+        assert store.get_user_config(USER_ID)["credit"] == 100
+        collection.find_one.assert_called_once()
+        assert store._config_reads == {}
+
+    def test_read_racing_with_a_write_is_not_cached(self, store):
+        collection = store.db[store.COLLECTIONS['user_config']]
+
+        def read_then_deduct(*args, **kwargs):
+            # A credit change lands after the document was read but before it is cached
+            store._update_cached_credit(USER_ID, 90)
+            return {"user_id": USER_ID, "credit": 100}
+
+        collection.find_one.side_effect = read_then_deduct
+        assert store.get_user_config(USER_ID)["credit"] == 100
+
+        collection.find_one.side_effect = None
+        collection.find_one.return_value = {"user_id": USER_ID, "credit": 90}
+        assert store.get_user_config(USER_ID)["credit"] == 90
+        assert collection.find_one.call_count == 2
+        assert store._config_reads == {}
+
+
+class TestSupportedModelsCache:
+    """Tests for the in-memory set of supported model names."""
+
+    def test_names_are_cached(self, store):
+        collection = store.db[store.COLLECTIONS['models']]
+        collection.find.return_value.batch_size.return_value = [{"model_name": "gpt-4"}]
+
+        assert store.model_exists("gpt-4") is True
+        assert store.model_exists("gpt-4") is True
+        collection.find.assert_called_once()
+
+    def test_refresh_racing_with_invalidation_is_not_cached(self, store):
+        collection = store.db[store.COLLECTIONS['models']]
+
+        def query_then_add_model(*args, **kwargs):
+            # A model is added after the names were read but before they are cached
+            store._invalidate_models_cache()
+            return [{"model_name": "gpt-4"}]
+
+        collection.find.return_value.batch_size.side_effect = query_then_add_model
+        assert store.model_exists("new-model") is False
+
+        collection.find.return_value.batch_size.side_effect = None
+        collection.find.return_value.batch_size.return_value = [{"model_name": "gpt-4"}, {"model_name": "new-model"}]
+        assert store.model_exists("new-model") is True
@@ -0,0 +1,253 @@
+# tests/utils/test_queue.py
+"""
+Test suite for the request queue: admission, ordering and the worker.
+"""
+import asyncio
+import pytest
+import pytest_asyncio
+from unittest.mock import Mock, AsyncMock
+
+from bot.utils import queue as queue_module
+from bot.utils.queue import RequestQueue, QueuedRequest
+
+# --- Fixtures ---
+
+OWNER_ID = 99999
+USER_ID = 12345
+OTHER_USER_ID = 54321
+
+def make_message(user_id):
+    """Create a fake Discord message from the given user."""
+    message = Mock()
+    message.author = Mock(id=user_id)
+    message.channel = Mock()
+    message.channel.send = AsyncMock()
+    return message
+
+@pytest_asyncio.fixture
+async def request_queue():
+    """A fresh queue whose bot reports OWNER_ID as the owner."""
+    queue = RequestQueue()
+    bot = Mock()
+    bot.owner_id = OWNER_ID
+    bot.owner_ids = None
+    queue.set_bot(bot)
+    yield queue
+    await queue.stop()
+
+@pytest.fixture
+def gate():
+    """Event that blocks the process callback until the test releases it."""
+    return asyncio.Event()
+
+@pytest.fixture
+def processed(request_queue, gate):
+    """Install a callback that records (user_id, text) once the gate is open."""
+    order = []
+
+    async def callback(request):
+        await gate.wait()
+        order.append((request.user_id, request.final_user_text))
+
+    request_queue.set_process_callback(callback)
+    return order
+
+async def settle():
+    """Let the worker run until it blocks again."""
+    for _ in range(5):
+        await asyncio.sleep(0)
+
+# --- Tests ---
+
+@pytest.mark.asyncio
+class TestAdmission:
+    """Tests for add_request admission checks."""
+
+    async def test_request_is_processed(self, request_queue, processed, gate):
+        gate.set()
+        assert await request_queue.add_request(make_message(USER_ID), "hello") == (True, None)
+        await settle()
+        assert processed == [(USER_ID, "hello")]
+        assert request_queue._inflight == {}
+
+    async def test_rejects_while_processing(self, request_queue, processed):
+        await request_queue.add_request(make_message(USER_ID), "first")
+        await settle()
+        success, reply = await request_queue.add_request(make_message(USER_ID), "second")
+        assert success is False
+        assert "being processed" in reply
+
+    async def test_rejects_second_queued_request(self, request_queue, processed):
+        await request_queue.add_request(make_message(OTHER_USER_ID), "blocker")
+        await settle()
+        await request_queue.add_request(make_message(USER_ID), "first")
+        success, reply = await request_queue.add_request(make_message(USER_ID), "second")
+        assert success is False
+        assert "already have a request in queue" in reply
+
+    async def test_rate_limits_non_owner_bursts(self, request_queue, processed, gate):
+        gate.set()
+        for i in range(int(queue_module.RATE_LIMIT_CAPACITY)):
+            assert (await request_queue.add_request(make_message(USER_ID), f"m{i}"))[0] is True
+            await settle()
+        success, reply = await request_queue.add_request(make_message(USER_ID), "too many")
+        assert success is False
+        assert reply.startswith("⏰")
+
+    async def test_owner_skips_rate_limit(self, request_queue, processed, gate):
+        gate.set()
+        for i in range(int(queue_module.RATE_LIMIT_CAPACITY) + 2):
+            assert (await request_queue.add_request(make_message(OWNER_ID), f"m{i}"))[0] is True
+            await settle()
+        assert OWNER_ID not in request_queue._buckets
+
+    async def test_caller_supplied_owner_flag(self, request_queue, processed):
+        await request_queue.add_request(make_message(OTHER_USER_ID), "blocker")
+        await settle()
+        await request_queue.add_request(make_message(USER_ID), "flagged", is_owner=True)
+        assert request_queue._by_user[USER_ID].is_owner is True
+        assert USER_ID not in request_queue._buckets
+
+    async def test_rejects_when_queue_is_full(self, request_queue, processed, monkeypatch):
+        monkeypatch.setattr(queue_module, "MAX_QUEUE_SIZE", 2)
+        await request_queue.add_request(make_message(1), "blocker")
+        await settle()
+        assert (await request_queue.add_request(make_message(2), "a"))[0] is True
+        assert (await request_queue.add_request(make_message(3), "b"))[0] is True
+        assert await request_queue.add_request(make_message(4), "c") == (
+            False, "⏳ Server is busy, try again in a moment."
+        )
+
+    async def test_caps_prompt_length(self, request_queue, processed):
+        await request_queue.add_request(make_message(OTHER_USER_ID), "blocker")
+        await settle()
+        await request_queue.add_request(make_message(USER_ID), "x" * (queue_module.MAX_PROMPT + 10))
+        assert len(request_queue._by_user[USER_ID].final_user_text) == queue_module.MAX_PROMPT
+
+
+@pytest.mark.asyncio
+class TestCancellation:
+    """Tests for cancel_user_request."""
+
+    async def test_cancelled_request_is_skipped(self, request_queue, processed, gate):
+        await request_queue.add_request(make_message(OTHER_USER_ID), "blocker")
+        await settle()
+        await request_queue.add_request(make_message(USER_ID), "cancel me")
+
+        assert request_queue.cancel_user_request(USER_ID) is True
+        assert request_queue.cancel_user_request(USER_ID) is False
+
+        gate.set()
+        await settle()
+        assert processed == [(OTHER_USER_ID, "blocker")]
+
+    async def test_user_can_queue_again_after_cancelling(self, request_queue, processed, gate):
+        await request_queue.add_request(make_message(OTHER_USER_ID), "blocker")
+        await settle()
+        await request_queue.add_request(make_message(USER_ID), "old")
+        request_queue.cancel_user_request(USER_ID)
+        assert (await request_queue.add_request(make_message(USER_ID), "new"))[0] is True
+
+        gate.set()
+        await settle()
+        assert processed == [(OTHER_USER_ID, "blocker"), (USER_ID, "new")]
+
+    async def test_cancelled_requests_do_not_use_capacity(self, request_queue, processed, monkeypatch):
+        monkeypatch.setattr(queue_module, "MAX_QUEUE_SIZE", 1)
+        await request_queue.add_request(make_message(1), "blocker")
+        await settle()
+        await request_queue.add_request(make_message(2), "a")
+        request_queue.cancel_user_request(2)
+        assert (await request_queue.add_request(make_message(3), "b"))[0] is True
+
+    async def test_cancel_unknown_user(self, request_queue):
+        assert request_queue.cancel_user_request(USER_ID) is False
+
+
+@pytest.mark.asyncio
+class TestWorker:
+    """Tests for ordering and error handling in the worker."""
+
+    async def test_owner_requests_go_first(self, request_queue, processed, gate):
+        await request_queue.add_request(make_message(1), "blocker")
+        await settle()
+        await request_queue.add_request(make_message(USER_ID), "user")
+        await request_queue.add_request(make_message(OWNER_ID), "owner")
+
+        gate.set()
+        await settle()
+        assert [text for _, text in processed] == ["blocker", "owner", "user"]
+
+    async def test_callback_error_is_reported_and_slot_released(self, request_queue):
+        request_queue.set_process_callback(AsyncMock(side_effect=RuntimeError("boom")))
+        message = make_message(USER_ID)
+
+        await request_queue.add_request(message, "hello")
+        await settle()
+
+        message.channel.send.assert_called_once()
+        assert "boom" in message.channel.send.call_args.args[0]
+        assert request_queue._inflight == {}
+
+    async def test_stop_drops_pending_requests(self, request_queue, processed):
+        await request_queue.add_request(make_message(1), "blocker")
+        await settle()
+        await request_queue.add_request(make_message(USER_ID), "pending")
+
+        await request_queue.stop()
+
+        assert request_queue._heap == []
+        assert request_queue._by_user == {}
+        assert request_queue._inflight == {}
+
+
+class TestQueuedRequestOrdering:
+    """Tests for the priority key of QueuedRequest."""
+
+    def make_request(self, is_owner, timestamp):
+        return QueuedRequest(message=None, user_id=0, is_owner=is_owner,
+                             timestamp=timestamp, final_user_text="")
+
+    def test_owner_beats_recent_user(self):
+        assert self.make_request(True, 100.0) < self.make_request(False, 90.0)
+
+    def test_earlier_request_wins_within_class(self):
+        assert self.make_request(False, 10.0) < self.make_request(False, 20.0)
+
+    def test_long_waiting_user_overtakes_owner(self):
+        wait = 1 / QueuedRequest.AGE_WEIGHT + 1
+        assert self.make_request(False, 0.0) < self.make_request(True, wait)
+
+
+@pytest.mark.asyncio
+class TestOwnerResolution:
+    """Tests for resolving owner IDs through the bot."""
+
+    async def test_uses_bot_is_owner_to_fill_owner_ids(self):
+        queue = RequestQueue()
+        bot = Mock()
+        bot.owner_id = None
+        bot.owner_ids = set()
+
+        async def is_owner(user):
+            # discord.py fills owner_ids from the application team on first use
+            bot.owner_ids = {OWNER_ID}
+            return user.id == OWNER_ID
+
+        bot.is_owner = AsyncMock(side_effect=is_owner)
+        queue.set_bot(bot)
+
+        assert await queue.is_owner(Mock(id=USER_ID)) is False
+        assert await queue.is_owner(Mock(id=OWNER_ID)) is True
+        bot.is_owner.assert_called_once()
+
+    async def test_lookup_failure_is_not_cached(self):
+        queue = RequestQueue()
+        bot = Mock()
+        bot.owner_id = None
+        bot.owner_ids = None
+        bot.is_owner = AsyncMock(side_effect=RuntimeError("offline"))
+        queue.set_bot(bot)
+
+        assert await queue.is_owner(Mock(id=OWNER_ID)) is False
+        assert queue._owner_ids is None